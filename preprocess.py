@@ -0,0 +1,61 @@
+import os
+import argparse
+import numpy as np
+import pandas as pd
+import torch
+import torchaudio
+
+SAMPLE_RATE = 16000
+
+
+def build_shard(bucketing_path, libri_root, set_name, output_dir):
+    """
+    Decode every utterance of <set_name> once into a single int16 PCM file
+    <output_dir>/<set_name>.bin, with (file_path, offset, length) rows in <set_name>_index.npy
+    """
+    table = pd.read_csv(os.path.join(bucketing_path, set_name + ".csv"))
+    file_paths = table["file_path"].tolist()
+
+    index = np.zeros(
+        len(file_paths),
+        # Sized to the longest path, a fixed width would silently truncate longer ones
+        dtype=[('file_path', f'U{max(len(p) for p in file_paths)}'), ('offset', np.int64), ('length', np.int64)],
+    )
+    offset = 0
+
+    with open(os.path.join(output_dir, set_name + ".bin"), 'wb') as f:
+        for i, file_path in enumerate(file_paths):
+            wav, sr = torchaudio.load(os.path.join(libri_root, file_path))
+            if sr != SAMPLE_RATE:
+                wav = torchaudio.functional.resample(wav, sr, SAMPLE_RATE)
+            wav = (wav.squeeze(0) * 32768).round().clamp(-32768, 32767).to(torch.int16)
+
+            f.write(wav.numpy().tobytes())
+            index[i] = (file_path, offset, len(wav))
+            offset += len(wav)
+
+    np.save(os.path.join(output_dir, set_name + "_index.npy"), index)
+    print(f"[Preprocess] - {set_name}: {len(file_paths)} utterances, {offset} samples")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument('-b', '--bucketing_path', default='./data/len_for_bucket',
+                        help='directory of the <set>.csv files')
+
+    parser.add_argument('-l', '--libri_root', required=True,
+                        help='root path to the LibriSpeech dataset')
+
+    parser.add_argument('-o', '--output_dir', required=True,
+                        help='directory to write the audio shards to (<shard_path> in the config)')
+
+    parser.add_argument('-s', '--sets', nargs='+',
+                        default=['train-clean-100', 'train-clean-360', 'train-other-500',
+                                 'dev-clean', 'dev-other', 'test-clean', 'test-other'])
+
+    args = parser.parse_args()
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    for set_name in args.sets:
+        build_shard(args.bucketing_path, args.libri_root, set_name, args.output_dir)
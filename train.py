@@ -35,6 +35,7 @@ class W2V2Distil(LightningModule):
         teacher_model = self.yaml_cfg['teacher']['teacher_model']
         self.teacher_model, teacher_config, self.task_agnostic = load_model_and_config(teacher_model)
         freeze_model(self.teacher_model)
+        remove_dropout(self.teacher_model)
 
         # Make student config independent of teacher
         self.model_cfg = self.yaml_cfg['distiller']
@@ -52,6 +53,9 @@ class W2V2Distil(LightningModule):
             teacher_model=self.teacher_model
         )
 
+        # Teacher is frozen, keep it in half precision after the student is initialized from it
+        self.teacher_model.half()
+
         self.cnn_loss_weight = self.train_cfg['cnn_loss_weight']
         self.rec_loss_weight = self.train_cfg['rec_loss_weight']
         self.rec_loss_type = self.train_cfg['rec_loss_type']
@@ -85,6 +89,15 @@ class W2V2Distil(LightningModule):
             specaug = SpecAug(**self.yaml_cfg['specaug'])
             self.student_model.add_specaug(specaug)
 
+        self.distill_loss = distill_loss
+        if self.train_cfg.get('compile', False):
+            # Compile the bound methods rather than wrapping the modules,
+            # so parameter names in checkpoints stay the same
+            self.student_model.forward = maybe_compile(self.student_model.forward, dynamic=True)
+            self.calculate_loss = maybe_compile(self.calculate_loss, dynamic=True)
+            # Sequence length varies between buckets
+            self.distill_loss = maybe_compile(distill_loss, dynamic=True)
+
         if self.train_cfg['distil_random_layer'] > 0:
             self.num_encoders = self.model_cfg['encoder_layers']
             self.all_enc = range(self.num_encoders-1)
@@ -92,53 +105,95 @@ class W2V2Distil(LightningModule):
         else:
             assert self.train_cfg['random_layer_weight'] == 0
 
+        if not self.task_agnostic:
+            self.decoder = Decoder()
+            self.ctc_converter = CTCSequenceConverter()
+            self.wer_metric = ErrorRate(level="word")
+            self.cer_metric = ErrorRate(level="char")
+            # Byte -> token id lookup table for ground truth labels, space is the word boundary '|'
+            # Characters out of the vocabulary become <unk>, a negative id would break F.ctc_loss on GPU
+            self._char_lut = np.full(256, self.decoder.dict['<unk>'], dtype=np.int64)
+            for char, idx in self.decoder.dict.items():
+                if len(char) == 1:
+                    self._char_lut[ord(char)] = idx
+            self._char_lut[ord(' ')] = self.decoder.dict['|']
+
         self.batch_size = self.train_cfg['batch_size']
         self.num_gpus = self.train_cfg['gpus']
         if isinstance(self.num_gpus, list):
             self.num_gpus = len(self.num_gpus)
+        # Every DDP process spawns its own workers, so split the cores left over by the main processes
+        self.num_workers = max(1, min((os.cpu_count() - self.num_gpus) // max(self.num_gpus, 1), 16))
         data_cfg = self.yaml_cfg['data']
         bucketing_path = data_cfg['bucketing_path']
         libri_root = data_cfg['libri_root']
+        shard_path = data_cfg.get('shard_path')
         train_set = data_cfg['train_set']
         test_set = data_cfg['test_set']
 
+        # Store teacher hiddens on disk during the first epoch and reuse them afterwards
+        # Only possible when the layer-wise feature loss is the only thing needed from the teacher
+        self.teacher_cache = None
+        if self.train_cfg.get('teacher_cache', False):
+            assert self.task_agnostic and self.train_cfg['distil_random_layer'] == 0
+            assert self.cnn_loss_weight == 0 and self.attn_loss_weight == 0 and self.v_rel_loss_weight == 0
+            self.teacher_cache = TeacherCache(
+                cache_dir=bucketing_path,
+                teacher_path=teacher_model,
+                layer_ids=self.student_model.pred_layer_id,
+            )
+
         # download & prepare data
         self.train_data = LibriDataset(
             batch_size=self.batch_size,
             file_path=bucketing_path,
             sets=train_set,
             libri_root=libri_root,
+            teacher_cache=self.teacher_cache,
+            shard_path=shard_path,
         )
         self.eval_data = LibriDataset(
             batch_size=self.batch_size,
             file_path=bucketing_path,
             sets=['dev-clean'],
             libri_root=libri_root,
+            teacher_cache=self.teacher_cache,
+            shard_path=shard_path,
         )
         self.test_data = LibriDataset(
             batch_size=self.batch_size,
             file_path=bucketing_path,
             sets=test_set,
             libri_root=libri_root,
+            teacher_cache=self.teacher_cache,
+            shard_path=shard_path,
         )
 
         # For better pytorch lightning logging
         logging.shutdown()
         reload(logging)
 
-    def forward(self, x, padding_mask=None):
-        # Seems like lightning had been using the teacher model as training mode the whole time
-        self.teacher_model.eval()
+    def forward(self, x, padding_mask=None, utt_ids=None, teacher_hiddens=None):
+        if teacher_hiddens is not None:
+            # Loaded from the teacher cache, skip the teacher entirely
+            teacher_results = {"hiddens": teacher_hiddens}
+        else:
+            # Seems like lightning had been using the teacher model as training mode the whole time
+            self.teacher_model.eval()
 
-        teacher_results = self.teacher_model.extract_features(
-            source=x, 
-            padding_mask=padding_mask,
-        )
-        # -> RETURNS: {
-        #     "x": (B x T x D) (encoder output),
-        #     "layer_results": [x, (attn, lr)] x #layers,
-        #     "features": [features]
-        # }
+            with torch.inference_mode(), torch.autocast(device_type='cuda', dtype=torch.float16):
+                teacher_results = self.teacher_model.extract_features(
+                    source=x, 
+                    padding_mask=padding_mask,
+                )
+            # -> RETURNS: {
+            #     "x": (B x T x D) (encoder output),
+            #     "layer_results": [x, (attn, lr)] x #layers,
+            #     "features": [features]
+            # }
+
+            if self.teacher_cache is not None:
+                self.teacher_cache.save(utt_ids, self.get_teacher_hiddens(teacher_results))
 
         student_results = self.student_model(
             source=x, 
@@ -164,8 +219,10 @@ class W2V2Distil(LightningModule):
             loss, losses = self.calculate_loss(student_results, teacher_results)
 
         if self.train_cfg['monitor_losses']:
+            # Not on the progress bar: Lightning converts prog_bar metrics to Python scalars every step,
+            # logger metrics are only synced every log_every_n_steps
             for k, v in losses.items():
-                self.log(k, v.item(), prog_bar=True)
+                self.log(k, v.detach())
 
         return loss
 
@@ -185,7 +242,8 @@ class W2V2Distil(LightningModule):
             loss, losses = self.calculate_loss(student_results, teacher_results)
 
         if not self.task_agnostic:
-            predicted_ids = np.argmax(student_results['encoder_out'].transpose(0,1).cpu().detach().numpy(), axis=-1)
+            # Only the token ids cross to the host, not the whole output
+            predicted_ids = student_results['encoder_out'].transpose(0,1).argmax(dim=-1).cpu().numpy()
             predictions = [self.decoder.decode(ids) for ids in predicted_ids]
 
             self.wer_metric.add_batch(predictions=predictions, references=batch['labels'])
@@ -215,7 +273,8 @@ class W2V2Distil(LightningModule):
             loss, losses = self.calculate_loss(student_results, teacher_results)
 
         if not self.task_agnostic:
-            predicted_ids = np.argmax(student_results['encoder_out'].transpose(0,1).cpu().detach().numpy(), axis=-1)
+            # Only the token ids cross to the host, not the whole output
+            predicted_ids = student_results['encoder_out'].transpose(0,1).argmax(dim=-1).cpu().numpy()
             predictions = [self.decoder.decode(ids) for ids in predicted_ids]
 
             wer = self.wer_metric.add_batch(predictions=predictions, references=batch['labels'])
@@ -233,29 +292,43 @@ class W2V2Distil(LightningModule):
             self.log("wer", wer, on_epoch=True, prog_bar=True, batch_size=self.batch_size)
             self.log("cer", cer, on_epoch=True, prog_bar=True, batch_size=self.batch_size)
 
+    def get_teacher_hiddens(self, teacher_results):
+        # Teacher hiddens of the layers in <pred_layer_id>: B x N x T x D
+        if "hiddens" not in teacher_results:
+            teacher_hiddens = [
+                teacher_results["layer_results"][i][0]
+                for i in self.student_model.pred_layer_id
+            ]
+            # Stack layers first and transpose once: N x T x B x D -> B x N x T x D
+            teacher_results["hiddens"] = torch.stack(teacher_hiddens, dim=0).permute(2, 0, 1, 3)
+        return teacher_results["hiddens"]
+
     def calculate_loss(self, student_results, teacher_results, labels=None):
         # TODO: move calculate_loss to utils?
         losses = {}
 
         # CNN post projection loss
         if self.cnn_loss_weight > 0:
-            cnn_loss = F.l1_loss(student_results["features"], teacher_results["features"][0], reduction="none")
+            # Teacher outputs are inference tensors, so they need a copy before being saved for backward
+            target = teacher_results["features"][0].to(student_results["features"].dtype, copy=True)
+            cnn_loss = F.l1_loss(student_results["features"], target, reduction="none")
             cnn_loss = cnn_loss.mean()
             losses['cnn_loss'] = cnn_loss
         else:
             cnn_loss = 0
 
         # Feature loss
-        if self.rec_loss_weight > 0:
+        if self.rec_loss_weight > 0 or self.sim_loss_weight > 0:
             if self.train_cfg['distil_random_layer'] > 0:
                 teacher_hiddens = [
-                teacher_results["layer_results"][l][0].transpose(0, 1)
+                    teacher_results["layer_results"][l][0]
                     for l in self.rand_l
                 ]
                 teacher_hiddens.append(
-                    teacher_results["layer_results"][-1][0].transpose(0, 1)
+                    teacher_results["layer_results"][-1][0]
                 )
-                teacher_hiddens = torch.stack(teacher_hiddens, dim=1)
+                # N x T x B x D -> B x N x T x D
+                teacher_hiddens = torch.stack(teacher_hiddens, dim=0).permute(2, 0, 1, 3)
                 
                 student_hiddens = [
                     student_results["projections"][l]
@@ -266,11 +339,7 @@ class W2V2Distil(LightningModule):
                 )
                 pred = torch.stack(student_hiddens, dim=1)
             else:
-                teacher_hiddens = [
-                    teacher_results["layer_results"][i][0].transpose(0, 1)
-                    for i in self.student_model.pred_layer_id
-                ]
-                teacher_hiddens = torch.stack(teacher_hiddens, dim=1)  # B x N x T x D
+                teacher_hiddens = self.get_teacher_hiddens(teacher_results)  # B x N x T x D
                 
                 if self.model_cfg['layerwise_proj']:
                     pred = torch.stack([
@@ -279,54 +348,47 @@ class W2V2Distil(LightningModule):
                     ], dim=1)
                 else:
                     pred = student_results['projections']
-            target = teacher_hiddens.narrow(2, 0, pred.shape[2])
+            target = teacher_hiddens.narrow(2, 0, pred.shape[2]).type_as(pred)
         
-            if self.rec_loss_type == 'l1':
-                rec_loss = F.l1_loss(pred, target, reduction="none")
-            elif self.rec_loss_type == 'mse':
-                rec_loss = F.mse_loss(pred, target, reduction="none")
-            else:
-                raise NotImplementedError("rec_loss_type must be one of 'l1', 'mse'.")
+            # Reconstruction & similarity losses in a single pass over pred/target
+            rec_loss, rec_layer_loss, sim_loss, sim_layer_loss = self.distill_loss(
+                pred,
+                target,
+                rec_loss_type=self.rec_loss_type if self.rec_loss_weight > 0 else None,
+                sim=self.sim_loss_weight > 0,
+            )
             if self.train_cfg['distil_random_layer'] > 0:
-                rec_loss[:, :-1] = rec_loss[:, :-1] * self.random_layer_weight
-                rec_layer_loss = rec_loss.mean((0, 2, 3))
+                # Down-weight the randomly picked layers, the last layer is kept as is
+                layer_weight = pred.new_full((pred.shape[1],), self.random_layer_weight)
+                layer_weight[-1] = 1.0
+                rec_layer_loss = rec_layer_loss * layer_weight
                 rec_loss = rec_layer_loss.sum()
-            else:
-                with torch.no_grad():
-                    rec_layer_loss = rec_loss.mean((0, 2, 3)) 
-                rec_loss = rec_loss.mean()
-        else:
-            rec_loss = 0
-            rec_layer_loss = 0
-        
-        if self.sim_loss_weight > 0:
-            sim_loss = -F.logsigmoid(F.cosine_similarity(pred, target, dim=-1))
-            if self.train_cfg['distil_random_layer'] > 0:
-                sim_loss[:, :-1] = sim_loss[:, :-1] * self.random_layer_weight
-                sim_layer_loss = sim_loss.mean((0, 2, 3))
+                sim_layer_loss = sim_layer_loss * layer_weight
                 sim_loss = sim_layer_loss.sum()
             else:
-                with torch.no_grad():
-                    sim_layer_loss = sim_loss.mean((0, 2))
-                sim_loss = sim_loss.mean()
-        else:
-            sim_loss = 0
-            sim_layer_loss = 0
+                if self.rec_loss_weight > 0:
+                    rec_layer_loss = rec_layer_loss.detach()
+                if self.sim_loss_weight > 0:
+                    sim_layer_loss = sim_layer_loss.detach()
 
-        feat_loss = torch.add(rec_layer_loss, sim_layer_loss)
+            # One of the two may be a plain 0 if its loss is disabled
+            feat_loss = rec_layer_loss + sim_layer_loss
 
-        if self.train_cfg['distil_random_layer'] > 0:
-            for i, l in enumerate(self.rand_l):
-                losses[f'rand_l{i}'] = feat_loss[i]
-            losses[f'l{self.num_encoders-1}'] = feat_loss[-1]
+            if self.train_cfg['distil_random_layer'] > 0:
+                for i, l in enumerate(self.rand_l):
+                    losses[f'rand_l{i}'] = feat_loss[i]
+                losses[f'l{self.num_encoders-1}'] = feat_loss[-1]
+            else:
+                for i, pred_id in enumerate(self.student_model.pred_layer_id):
+                    losses[f'layer{pred_id}'] = feat_loss[i]
         else:
-            for i, pred_id in enumerate(self.student_model.pred_layer_id):
-                losses[f'layer{pred_id}'] = feat_loss[i]
+            rec_loss = 0
+            sim_loss = 0
 
         # Attention distribution transfer loss
         if self.attn_loss_weight > 0:
             pred = student_results['layer_results'][-1][1][0]
-            target = teacher_results['layer_results'][-1][1][0][0]
+            target = teacher_results['layer_results'][-1][1][0][0].to(pred.dtype, copy=True)
 
             if self.attn_loss_type == 'mse':
                 loss = F.mse_loss(
@@ -379,28 +441,29 @@ class W2V2Distil(LightningModule):
 
         if not self.task_agnostic:
             # Process output for CTC loss
-            ctc_input = student_results['x'].log_softmax(2) # -> Revise this
+            # fp32 log probs for CTC: native autocast already runs log_softmax in fp32, this only matters under apex
+            ctc_input = student_results['x'].log_softmax(2, dtype=torch.float32) # -> Revise this
 
             if self.train_cfg['use_gt_for_ctc']:
                 # Use Ground Truth labels instead of labels from the teacher model
-                gt_tokens = [torch.tensor([self.char_dict[char] for char in label]) for label in labels]
-                target = torch.cat(gt_tokens)
+                gt_tokens = [self._char_lut[np.frombuffer(label.encode('ascii'), dtype=np.uint8)] for label in labels]
+                target = torch.from_numpy(np.concatenate(gt_tokens)).to(ctc_input.device, non_blocking=True)
                 target_lengths = torch.tensor([len(tokens) for tokens in gt_tokens])
             else:
                 logits = teacher_results['x'].transpose(0,1)
                 predicted_ids = torch.argmax(logits, dim=-1)
-                fused_tokens = [self.ctc_converter(ids) for ids in predicted_ids]
-                target = torch.cat(fused_tokens)
-                target_lengths = torch.tensor([len(tokens) for tokens in fused_tokens])
+                target, target_lengths = self.ctc_converter.batch(predicted_ids)
 
+            # Lengths stay on CPU: F.ctc_loss copies them to the host before launching the kernel anyway
+            input_lengths = torch.full((ctc_input.shape[1],), ctc_input.shape[0], dtype=torch.long)
             ctc_loss = F.ctc_loss(
                 ctc_input, 
                 target, 
-                torch.full((ctc_input.shape[1],), ctc_input.shape[0]),
+                input_lengths,
                 target_lengths
             )
 
-            losses.append(ctc_loss)
+            losses['ctc_loss'] = ctc_loss
 
         return total_loss, losses
 
@@ -408,9 +471,9 @@ class W2V2Distil(LightningModule):
         # optimizer = torch.optim.AdamW(self.parameters(), lr=eval(self.yaml_cfg['optimizer']['lr']))
         # scheduler = torch.optim.lr_scheduler.ReduceLROnPlateau(optimizer, patience=8, factor=0.1, verbose=True)
         
-        train_batches = len(self.train_dataloader()) // self.num_gpus
+        # The dataset is already bucketed, so its length is the number of batches
+        train_batches = len(self.train_data) // self.num_gpus
         num_training_steps = (self.train_cfg['num_epochs'] * train_batches) // self.train_cfg['accumulate_grad_batches']
-        num_warmup_steps = int(num_training_steps * self.yaml_cfg['optimizer']['warmup_proportion'])
 
         return {
             "optimizer": get_optimizer(
@@ -421,23 +484,33 @@ class W2V2Distil(LightningModule):
         }
 
     def train_dataloader(self):
+        # Batches are already bucketed by the dataset, disable automatic batching
         return DataLoader(self.train_data,
-                          batch_size=1,
+                          batch_size=None,
                           shuffle=True,
                           collate_fn=self.train_data.collate_fn,
-                          num_workers=self.num_gpus*4)
+                          pin_memory=True,
+                          num_workers=self.num_workers,
+                          persistent_workers=True,
+                          prefetch_factor=4)
 
     def val_dataloader(self):
         return DataLoader(self.eval_data,
-                          batch_size=1,
+                          batch_size=None,
                           collate_fn=self.eval_data.collate_fn,
-                          num_workers=self.num_gpus*4)
+                          pin_memory=True,
+                          num_workers=self.num_workers,
+                          persistent_workers=True,
+                          prefetch_factor=4)
     
     def test_dataloader(self):
         return DataLoader(self.test_data,
-                          batch_size=1,
+                          batch_size=None,
                           collate_fn=self.test_data.collate_fn,
-                          num_workers=self.num_gpus*4)
+                          pin_memory=True,
+                          num_workers=self.num_workers,
+                          persistent_workers=True,
+                          prefetch_factor=4)
 
     def get_progress_bar_dict(self):
         tqdm_dict = super().get_progress_bar_dict()
@@ -457,6 +530,12 @@ if __name__ == '__main__':
 
     args = parser.parse_args()
 
+    # Use TF32 tensor cores for the remaining fp32 matmuls & convolutions (Ampere+)
+    torch.backends.cuda.matmul.allow_tf32 = True
+    torch.backends.cudnn.allow_tf32 = True
+    if hasattr(torch, 'set_float32_matmul_precision'):
+        torch.set_float32_matmul_precision('high')
+
     YAML_PATH = args.config or './data/conf/ex.yaml'
     with open(YAML_PATH) as f:
         YAML_CFG = yaml.load(f, Loader = yaml.FullLoader)
@@ -468,6 +547,10 @@ if __name__ == '__main__':
     num_epochs = YAML_CFG['train']['num_epochs']
     use_fp16 = 16 if YAML_CFG['train']['use_fp16'] else 32
     use_apex = 'apex' if YAML_CFG['train']['use_apex'] else 'native'
+    if YAML_CFG['train'].get('use_bf16', False):
+        # bf16 needs no loss scaling, only supported by native amp
+        use_fp16 = 'bf16'
+        use_apex = 'native'
     accumulate_grad_batches = YAML_CFG['train']['accumulate_grad_batches']
 
     model = W2V2Distil(cfg = YAML_CFG)
@@ -1,2 +1,2 @@
-from .dataset import LibriDataset
+from .dataset import LibriDataset, TeacherCache
 from .utils import *
\ No newline at end of file
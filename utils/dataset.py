@@ -2,12 +2,51 @@
 
 import os
 import random
+import hashlib
+import numpy as np
 import pandas as pd
 import torch
-from torch.nn.utils.rnn import pad_sequence
 from torch.utils.data.dataset import Dataset
 import torchaudio
 
+class TeacherCache:
+    """
+    On-disk cache of the frozen teacher's hidden states
+    Hiddens of <layer_ids> are stored per bucket as fp16 .npy files (B x N x T x D),
+    so dataloader workers can load them instead of running the teacher on the following epochs
+    """
+
+    def __init__(self, cache_dir, teacher_path, layer_ids):
+        # Checkpoints with the same file name in different directories must not share a cache
+        teacher_name = os.path.splitext(os.path.basename(teacher_path))[0]
+        teacher_hash = hashlib.sha1(os.path.abspath(teacher_path).encode()).hexdigest()[:10]
+        layer_tag = '_'.join(str(l) for l in layer_ids)
+        self.cache_dir = os.path.join(cache_dir, 'teacher_cache', f'{teacher_name}_{teacher_hash}', layer_tag)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, utt_ids):
+        # Hiddens are padded to the longest utterance of the bucket,
+        # so the key is the exact bucket composition (changes with batch size or bucketing csv)
+        bucket_hash = hashlib.sha1('\n'.join(utt_ids).encode()).hexdigest()
+        return os.path.join(self.cache_dir, bucket_hash + '.npy')
+
+    def load(self, utt_ids):
+        # Returns B x N x T x D, or None if the bucket is not cached yet
+        path = self._path(utt_ids)
+        if not os.path.exists(path):
+            return None
+        return torch.from_numpy(np.load(path))
+
+    def save(self, utt_ids, hiddens):
+        # hiddens: B x N x T x D
+        path = self._path(utt_ids)
+        tmp_path = path + f'.{os.getpid()}.tmp'
+        # Write then rename, so readers in other workers/ranks never see partial files
+        with open(tmp_path, 'wb') as f:
+            np.save(f, hiddens.detach().half().cpu().numpy())
+        os.replace(tmp_path, path)
+
+
 class LibriDataset(Dataset):
     """Librispeech Waveform Dataset for Distillation"""
 
@@ -16,11 +55,24 @@ class LibriDataset(Dataset):
         batch_size,
         file_path='/workspace/s3prl/s3prl/data/len_for_bucket/',
         sets=['train-clean-100', 'train-clean-360', 'train-other-500'],
-        libri_root='/workspace/LibriSpeech/'
+        libri_root='/workspace/LibriSpeech/',
+        teacher_cache=None,
+        shard_path=None,
     ):
         super().__init__()
 
         self.libri_root = libri_root
+        self.teacher_cache = teacher_cache
+
+        # Read waveforms from the int16 shards made by preprocess.py instead of decoding flac files
+        self.shard_path = shard_path
+        self.shard_index = {}
+        self._shards = {}
+        if shard_path is not None:
+            for s in sets:
+                index = np.load(os.path.join(shard_path, s + "_index.npy"))
+                for file_path, offset, length in index:
+                    self.shard_index[str(file_path)] = (s, int(offset), int(length))
 
         # Read file
         self.root = file_path
@@ -53,10 +105,27 @@ class LibriDataset(Dataset):
             self.X.append(batch_x)
 
     def collate_fn(self, items):
-        items = items[0]
+        # Each item is already a whole bucket, DataLoader must use batch_size=None
+        if self.teacher_cache is not None:
+            teacher_hiddens = self.teacher_cache.load(items['utt_ids'])
+            if teacher_hiddens is not None:
+                items['teacher_hiddens'] = teacher_hiddens
         return items
 
+    def _get_shard(self, set_name):
+        # Opened lazily, so that each dataloader worker maps the file itself
+        if set_name not in self._shards:
+            self._shards[set_name] = np.memmap(
+                os.path.join(self.shard_path, set_name + ".bin"), dtype=np.int16, mode='r'
+            )
+        return self._shards[set_name]
+
     def _load_feat(self, feat_path):
+        if self.shard_path is not None:
+            set_name, offset, length = self.shard_index[feat_path]
+            # Raw int16 samples, scaled once for the whole padded batch in __getitem__
+            return torch.from_numpy(np.array(self._get_shard(set_name)[offset:offset + length]))
+
         wav, _ = torchaudio.load(os.path.join(self.libri_root, feat_path))
         return wav.squeeze()
 
@@ -69,9 +138,16 @@ class LibriDataset(Dataset):
             torch.arange(max(wav_lengths)).unsqueeze(0),
             wav_lengths.unsqueeze(1),
         )
-        padded_wav = pad_sequence(wave_orig, batch_first=True)
-
-        return {'x': padded_wav, 'padding_mask': wav_padding_mask}
+        # Pad straight into a single float buffer, int16 shard samples are converted on the copy
+        # Pinning is left to the DataLoader (pin_memory=True): tensors pinned inside worker
+        # processes are copied again when they are sent to the main process
+        padded_wav = torch.zeros(len(wave_orig), int(wav_lengths.max()))
+        for i, wav in enumerate(wave_orig):
+            padded_wav[i, :len(wav)] = wav
+        if self.shard_path is not None:
+            padded_wav.mul_(1 / 32768)
+
+        return {'x': padded_wav, 'padding_mask': wav_padding_mask, 'utt_ids': self.X[index]}
 
     def __len__(self):
         return len(self.X)
\ No newline at end of file
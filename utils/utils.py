@@ -1,5 +1,6 @@
 import os
 import yaml
+import warnings
 import torch
 import numpy as np
 import torch.nn as nn
@@ -19,6 +20,11 @@ from fairseq.models.wav2vec.wav2vec2_asr import Wav2VecCtc, Wav2Vec2CtcConfig
 from fairseq.models.hubert.hubert import HubertModel, HubertConfig
 from omegaconf.omegaconf import open_dict
 
+try:
+    from rapidfuzz.distance import Levenshtein
+except ImportError:
+    Levenshtein = None
+
 
 class Decoder:
     def __init__(self):
@@ -37,16 +43,78 @@ class Decoder:
         return output
 
 
+def edit_distance(hyp, ref):
+    """Levenshtein distance between two sequences (strings or lists of words)"""
+    if Levenshtein is not None:
+        # C++ bit-parallel implementation
+        return Levenshtein.distance(hyp, ref)
+
+    prev = list(range(len(ref) + 1))
+    for i, h in enumerate(hyp, 1):
+        curr = [i]
+        for j, r in enumerate(ref, 1):
+            curr.append(min(prev[j] + 1, curr[j - 1] + 1, prev[j - 1] + (h != r)))
+        prev = curr
+    return prev[-1]
+
+
+class ErrorRate:
+    """
+    WER/CER accumulated as two integers (total edits, total reference length) over an epoch
+    Follows the add_batch()/compute() usage of the datasets metrics
+    """
+    def __init__(self, level="word"):
+        assert level in ["word", "char"]
+        if Levenshtein is None:
+            warnings.warn(
+                "rapidfuzz is not installed, falling back to a pure Python edit distance. "
+                "WER/CER will be very slow, install it with `pip install rapidfuzz`."
+            )
+        self.level = level
+        self.reset()
+
+    def reset(self):
+        self.edits = 0
+        self.ref_len = 0
+
+    def _tokenize(self, sentence):
+        return sentence.split() if self.level == "word" else sentence
+
+    def add_batch(self, predictions, references):
+        for pred, ref in zip(predictions, references):
+            pred, ref = self._tokenize(pred), self._tokenize(ref)
+            self.edits += edit_distance(pred, ref)
+            self.ref_len += len(ref)
+
+    def compute(self):
+        error_rate = self.edits / max(self.ref_len, 1)
+        self.reset()
+        return error_rate
+
+
 class CTCSequenceConverter:
     def __init__(self, return_type="pt"):
         self.return_type = return_type
         
     def __call__(self, ids):
         if self.return_type == "pt":
-            return torch.tensor([tok[0] for tok in groupby(ids) if tok[0] != 0])
+            # Collapse repeats & remove blanks without leaving the device of <ids>
+            ids = torch.unique_consecutive(torch.as_tensor(ids))
+            return ids[ids != 0]
         
         return [tok[0] for tok in groupby(ids) if tok[0] != 0]
 
+    def batch(self, ids):
+        """
+        Collapse repeats & remove blanks of a whole B x T batch at once
+        Returns tokens of all sequences concatenated (as F.ctc_loss expects) and their lengths
+        """
+        keep = torch.ones_like(ids, dtype=torch.bool)
+        keep[:, 1:] = ids[:, 1:] != ids[:, :-1]
+        keep &= ids != 0
+        # Row-major masking keeps each sequence's tokens in order
+        return ids[keep], keep.sum(1)
+
 
 class TeacherWrapper(nn.Module):
     def __init__(
@@ -190,6 +258,59 @@ def freeze_model(model):
         param.requires_grad = False
 
 
+def remove_dropout(model):
+    """
+    Replace nn.Dropout modules of a frozen model with nn.Identity
+    FairseqDropout is kept, since fairseq's MultiheadAttention reads its probability
+    """
+    for name, module in model.named_children():
+        if isinstance(module, nn.Dropout):
+            setattr(model, name, nn.Identity())
+        else:
+            remove_dropout(module)
+
+
+def maybe_compile(fn, **kwargs):
+    """Compile with torch.compile if it is available (torch >= 2.0)"""
+    if hasattr(torch, 'compile'):
+        return torch.compile(fn, **kwargs)
+    return fn
+
+
+def distill_loss(pred, target, rec_loss_type='l1', sim=True, eps=1e-8):
+    """
+    Layer-wise reconstruction & similarity losses between pred and target (B x N x T x D)
+    Both are computed in one function so that, when compiled, the kernel walks pred/target only once
+    Returns (rec_loss, rec_layer_loss, sim_loss, sim_layer_loss), 0 for disabled losses
+    """
+    # Both losses in fp32, as autocast does for F.l1_loss/F.mse_loss:
+    # squared differences and squared norms easily overflow in fp16
+    pred, target = pred.float(), target.float()
+
+    # Every layer has the same number of elements,
+    # so the global means are taken from the layer-wise means instead of another full reduction
+    rec_loss, rec_layer_loss = 0, 0
+    if rec_loss_type is not None:
+        if rec_loss_type == 'l1':
+            rec_layer_loss = (pred - target).abs().mean((0, 2, 3))
+        elif rec_loss_type == 'mse':
+            rec_layer_loss = (pred - target).pow(2).mean((0, 2, 3))
+        else:
+            raise NotImplementedError("rec_loss_type must be one of 'l1', 'mse'.")
+        rec_loss = rec_layer_loss.mean()
+
+    sim_loss, sim_layer_loss = 0, 0
+    if sim:
+        # -logsigmoid(cos) == softplus(-cos)
+        cos = (pred * target).sum(-1) * torch.rsqrt(
+            ((pred * pred).sum(-1) * (target * target).sum(-1)).clamp_min(eps * eps)
+        )
+        sim_layer_loss = F.softplus(-cos).mean((0, 2))
+        sim_loss = sim_layer_loss.mean()
+
+    return rec_loss, rec_layer_loss, sim_loss, sim_layer_loss
+
+
 def rtrn_attn_forward(
     self,
     x: torch.Tensor,